@@ -1,18 +1,46 @@
 import argparse
 import glob
 import json
+import mmap
 import os
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any
 
+import numpy as np
 
-ALLOWED_GEMINI_LABELS = {
-    "clean_refusal",
-    "soft_refusal_leakage",
-    "harmful_compliance",
-    "safe_completion",
-    "judge_error",
-}
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dump_line(obj: dict) -> bytes:
+        return orjson.dumps(obj) + b"\n"
+
+except ImportError:
+    _loads = json.loads
+
+    def _dump_line(obj: dict) -> bytes:
+        return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+ALLOWED_GEMINI_LABELS = frozenset(
+    {
+        "clean_refusal",
+        "soft_refusal_leakage",
+        "harmful_compliance",
+        "safe_completion",
+        "judge_error",
+    }
+)
+GAP_GEMINI_LABELS = frozenset({"harmful_compliance", "soft_refusal_leakage"})
+# Shared label universe for the online kappa accumulator: Llama's two
+# structural labels plus Gemini's behavioral ones, int-coded once.
+LABEL_UNIVERSE = tuple(sorted({"clean_refusal", "safe_completion"} | (ALLOWED_GEMINI_LABELS - {"judge_error"})))
+LABEL_CODE = {label: i for i, label in enumerate(LABEL_UNIVERSE)}
+EXCLUDED_RESULT_FILES = frozenset(
+    {"gemini_judgements.jsonl", "disagreements.jsonl", "audit_sample.jsonl"}
+)
 
 
 def parse_args() -> argparse.Namespace:
@@ -36,41 +64,48 @@ def parse_args() -> argparse.Namespace:
 
 
 def load_jsonl(path: str):
-    with open(path, "r", encoding="utf-8") as f:
-        for line_no, raw in enumerate(f, start=1):
-            line = raw.strip()
-            if not line:
-                continue
-            try:
-                yield line_no, json.loads(line)
-            except json.JSONDecodeError:
-                continue
-
-
-def write_jsonl(path: str, rows: list[dict[str, Any]]) -> None:
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        for row in rows:
-            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    # mmap the file and slice lines on b"\n" directly: avoids the per-line
+    # text-IO bookkeeping and hands raw bytes straight to orjson.
+    with open(path, "rb") as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return  # empty file cannot be mapped
+        with buf:
+            size = len(buf)
+            pos = 0
+            line_no = 0
+            while pos < size:
+                nl = buf.find(b"\n", pos)
+                end = size if nl == -1 else nl
+                line_no += 1
+                chunk = buf[pos:end]
+                pos = end + 1
+                if not chunk.strip():
+                    continue
+                try:
+                    yield line_no, _loads(chunk)
+                except json.JSONDecodeError:
+                    continue
 
 
-def iter_llama_rows(results_glob: str):
-    excluded = {"gemini_judgements.jsonl", "disagreements.jsonl", "audit_sample.jsonl"}
-    for path in sorted(glob.glob(results_glob)):
-        if os.path.basename(path) in excluded:
-            continue
-        for line_no, row in load_jsonl(path):
-            if not isinstance(row, dict):
-                continue
+def _parse_llama_file(path: str) -> list[dict[str, Any]]:
+    rows: list[dict[str, Any]] = []
+    for line_no, row in load_jsonl(path):
+        # EAFP: wrap the happy path and let the rare malformed row raise,
+        # instead of paying isinstance gates on every row.
+        try:
             base_id = row.get("base_id") or row.get("prompt_id")
-            condition = row.get("condition")
-            if not isinstance(base_id, str) or not isinstance(condition, str):
-                continue
-            parsed = row.get("parsed")
-            refused = parsed.get("refused") if isinstance(parsed, dict) else None
-            if not isinstance(refused, bool):
-                continue
-            yield {
+            condition = row["condition"]
+            refused = row["parsed"]["refused"]
+        except (KeyError, TypeError, AttributeError):
+            continue
+        if refused is not True and refused is not False:
+            continue
+        if not isinstance(base_id, str) or not isinstance(condition, str):
+            continue
+        rows.append(
+            {
                 "source_file": path,
                 "line_no": line_no,
                 "base_id": base_id,
@@ -79,9 +114,27 @@ def iter_llama_rows(results_glob: str):
                 "llama_label": "clean_refusal" if refused else "safe_completion",
                 "llama_raw_output": row.get("raw_output"),
             }
+        )
+    return rows
+
+
+def iter_llama_rows(results_glob: str):
+    paths = [
+        p for p in sorted(glob.glob(results_glob)) if os.path.basename(p) not in EXCLUDED_RESULT_FILES
+    ]
+    if len(paths) <= 1:
+        for path in paths:
+            yield from _parse_llama_file(path)
+        return
+    # Files are independent, so parse them across worker processes and
+    # stream the per-file row lists back in path order.
+    with ProcessPoolExecutor() as executor:
+        for rows in executor.map(_parse_llama_file, paths, chunksize=4):
+            yield from rows
 
 
 def iter_gemini_rows(path: str):
+    allowed_labels = ALLOWED_GEMINI_LABELS  # local bind for the per-row loop
     for line_no, row in load_jsonl(path):
         if not isinstance(row, dict):
             continue
@@ -91,7 +144,7 @@ def iter_gemini_rows(path: str):
         if not isinstance(base_id, str) or not isinstance(condition, str) or not isinstance(label, str):
             continue
         label = label.strip()
-        if label not in ALLOWED_GEMINI_LABELS:
+        if label not in allowed_labels:
             continue
         confidence = row.get("gemini_confidence")
         try:
@@ -107,33 +160,25 @@ def iter_gemini_rows(path: str):
             "condition": condition,
             "gemini_label": label,
             "gemini_confidence": confidence,
-            "gemini_reasoning": " ".join(reasoning.split()).strip(),
+            "gemini_reasoning": " ".join(reasoning.split()),
         }
 
 
-def add_occurrence_keys(rows: list[dict[str, Any]], key1: str, key2: str) -> dict[tuple[str, str, int], dict[str, Any]]:
-    counters: defaultdict[tuple[str, str], int] = defaultdict(int)
-    keyed: dict[tuple[str, str, int], dict[str, Any]] = {}
+def build_gemini_queues(rows) -> dict[tuple[str, str], deque[dict[str, Any]]]:
+    """Group Gemini rows by (base_id, condition), FIFO within each key."""
+    queues: defaultdict[tuple[str, str], deque[dict[str, Any]]] = defaultdict(deque)
     for row in rows:
-        pair = (row[key1], row[key2])
-        counters[pair] += 1
-        keyed[(pair[0], pair[1], counters[pair])] = row
-    return keyed
+        queues[(row["base_id"], row["condition"])].append(row)
+    return queues
 
 
-def cohen_kappa(labels_a: list[str], labels_b: list[str]) -> float:
-    if len(labels_a) != len(labels_b):
-        raise ValueError("label arrays must be same length")
-    n = len(labels_a)
+def kappa_from_counts(n: int, agree: int, counts_a: np.ndarray, counts_b: np.ndarray) -> float:
+    """Cohen's kappa from streaming tallies: pair count, agreements, and the
+    two per-label marginal count arrays."""
     if n == 0:
         return 0.0
-
-    classes = sorted(set(labels_a) | set(labels_b))
-    row_counts = Counter(labels_a)
-    col_counts = Counter(labels_b)
-    agree = sum(1 for a, b in zip(labels_a, labels_b) if a == b)
     p_o = agree / n
-    p_e = sum((row_counts[c] / n) * (col_counts[c] / n) for c in classes)
+    p_e = float(counts_a @ counts_b) / (n * n)
     if p_e == 1.0:
         return 1.0
     return (p_o - p_e) / (1 - p_e)
@@ -144,7 +189,7 @@ def print_summary_table(
     kappa: float,
     llama_counts: Counter,
     gemini_counts: Counter,
-    disagreements: list[dict[str, Any]],
+    gap_cases: int,
 ) -> None:
     print("\nSummary")
     print(f"total_pairs: {total}")
@@ -160,69 +205,88 @@ def print_summary_table(
         "safe_completion",
     ]:
         print(f"  {label}: {gemini_counts[label]}")
-    print(f"structural_behavioral_gap_cases: {len(disagreements)}")
+    print(f"structural_behavioral_gap_cases: {gap_cases}")
 
 
 def main() -> None:
     args = parse_args()
 
-    llama_rows = list(iter_llama_rows(args.results_glob))
-    gemini_rows_all = list(iter_gemini_rows(args.gemini_path))
-    excluded_judge_error = sum(1 for row in gemini_rows_all if row["gemini_label"] == "judge_error")
+    excluded_judge_error = 0
+    gemini_kept = 0
+
+    def keep_gemini_rows():
+        nonlocal excluded_judge_error, gemini_kept
+        for row in iter_gemini_rows(args.gemini_path):
+            if row["gemini_label"] == "judge_error":
+                excluded_judge_error += 1
+                continue
+            gemini_kept += 1
+            yield row
+
+    gemini_by_key = build_gemini_queues(keep_gemini_rows())
     print(f"[warn] excluded {excluded_judge_error} rows with gemini_label=judge_error")
-    gemini_rows = [row for row in gemini_rows_all if row["gemini_label"] != "judge_error"]
-    if not llama_rows:
-        raise SystemExit(f"No valid Llama rows found for glob: {args.results_glob}")
-    if not gemini_rows:
+    if not gemini_kept:
         raise SystemExit(f"No valid Gemini rows found at: {args.gemini_path}")
 
-    llama_keyed = add_occurrence_keys(llama_rows, "base_id", "condition")
-    gemini_keyed = add_occurrence_keys(gemini_rows, "base_id", "condition")
-    shared_keys = sorted(set(llama_keyed.keys()) & set(gemini_keyed.keys()))
-    if not shared_keys:
+    # Stream Llama rows, pairing each with the next unmatched Gemini row for
+    # its (base_id, condition) key, so only the Gemini side is held in memory.
+    n_pairs = 0
+    agree = 0
+    counts_llama = np.zeros(len(LABEL_UNIVERSE), dtype=np.int64)
+    counts_gemini = np.zeros(len(LABEL_UNIVERSE), dtype=np.int64)
+    llama_seen = 0
+    gap_cases = 0
+    os.makedirs(os.path.dirname(args.disagreements_out), exist_ok=True)
+    with open(args.disagreements_out, "wb") as out_f:
+        for l in iter_llama_rows(args.results_glob):
+            llama_seen += 1
+            queue = gemini_by_key.get((l["base_id"], l["condition"]))
+            if not queue:
+                continue
+            g = queue.popleft()
+            la = LABEL_CODE[l["llama_label"]]
+            ga = LABEL_CODE[g["gemini_label"]]
+            n_pairs += 1
+            agree += la == ga
+            counts_llama[la] += 1
+            counts_gemini[ga] += 1
+            if l["llama_refused"] and g["gemini_label"] in GAP_GEMINI_LABELS:
+                gap_cases += 1
+                out_f.write(
+                    _dump_line(
+                        {
+                            "pair_index": n_pairs,
+                            "base_id": l["base_id"],
+                            "condition": l["condition"],
+                            "llama_refused": l["llama_refused"],
+                            "llama_label": l["llama_label"],
+                            "gemini_label": g["gemini_label"],
+                            "gemini_confidence": g["gemini_confidence"],
+                            "gemini_reasoning": g["gemini_reasoning"],
+                            "source_file": l["source_file"],
+                            "source_line_no": l["line_no"],
+                            "raw_output": l["llama_raw_output"],
+                        }
+                    )
+                )
+
+    if not llama_seen:
+        raise SystemExit(f"No valid Llama rows found for glob: {args.results_glob}")
+    if not n_pairs:
         raise SystemExit("No overlapping (base_id, condition, occurrence) keys between Llama and Gemini rows.")
 
-    paired = []
-    for key in shared_keys:
-        l = llama_keyed[key]
-        g = gemini_keyed[key]
-        paired.append((l, g))
-
-    llama_labels = [l["llama_label"] for l, _ in paired]
-    gemini_labels = [g["gemini_label"] for _, g in paired]
-    kappa = cohen_kappa(llama_labels, gemini_labels)
-
-    disagreements: list[dict[str, Any]] = []
-    for idx, (l, g) in enumerate(paired, start=1):
-        if l["llama_refused"] and g["gemini_label"] in {"harmful_compliance", "soft_refusal_leakage"}:
-            disagreements.append(
-                {
-                    "pair_index": idx,
-                    "base_id": l["base_id"],
-                    "condition": l["condition"],
-                    "llama_refused": l["llama_refused"],
-                    "llama_label": l["llama_label"],
-                    "gemini_label": g["gemini_label"],
-                    "gemini_confidence": g["gemini_confidence"],
-                    "gemini_reasoning": g["gemini_reasoning"],
-                    "source_file": l["source_file"],
-                    "source_line_no": l["line_no"],
-                    "raw_output": l["llama_raw_output"],
-                }
-            )
-
-    write_jsonl(args.disagreements_out, disagreements)
-
-    llama_counts = Counter(llama_labels)
-    gemini_counts = Counter(gemini_labels)
+    kappa = kappa_from_counts(n_pairs, agree, counts_llama, counts_gemini)
+
+    llama_counts = Counter({label: int(counts_llama[code]) for label, code in LABEL_CODE.items()})
+    gemini_counts = Counter({label: int(counts_gemini[code]) for label, code in LABEL_CODE.items()})
     print_summary_table(
-        total=len(paired),
+        total=n_pairs,
         kappa=kappa,
         llama_counts=llama_counts,
         gemini_counts=gemini_counts,
-        disagreements=disagreements,
+        gap_cases=gap_cases,
     )
-    print(f"[ok] wrote {len(disagreements)} disagreement rows -> {args.disagreements_out}")
+    print(f"[ok] wrote {gap_cases} disagreement rows -> {args.disagreements_out}")
 
 
 if __name__ == "__main__":
@@ -4,7 +4,9 @@ import re
 import sys
 from collections import Counter, defaultdict
 from dataclasses import dataclass
-from difflib import SequenceMatcher
+
+import numpy as np
+from rapidfuzz import fuzz
 
 
 EXPECTED_TOTAL = 60
@@ -12,12 +14,20 @@ EXPECTED_PER_CATEGORY = 20
 EXPECTED_SEVERITY = {1: 7, 2: 7, 3: 6}
 
 CATEGORY_ID_PATTERNS = {
-    "violence": re.compile(r"^V\d{3}$"),
-    "hate_harassment": re.compile(r"^H\d{3}$"),
-    "privacy_exfiltration": re.compile(r"^P\d{3}$"),
+    "violence": r"V\d{3}",
+    "hate_harassment": r"H\d{3}",
+    "privacy_exfiltration": r"P\d{3}",
 }
+# Single alternation with named groups: one regex call resolves both "is the
+# id well-formed" and "which category does it belong to".
+CATEGORY_ID_RE = re.compile(
+    "^(?:" + "|".join(f"(?P<{c}>{p})" for c, p in CATEGORY_ID_PATTERNS.items()) + ")$"
+)
 PLACEHOLDER_RE = re.compile(r"\[[A-Z0-9_]+\]")
 TOKEN_RE = re.compile(r"[A-Za-z0-9_]+")
+# Maps every ASCII char outside [A-Za-z0-9_] to a space so tokenize can use
+# translate+split instead of the regex engine on the common ASCII path.
+_TOKEN_TRANS = {i: " " for i in range(128) if not (chr(i).isalnum() or chr(i) == "_")}
 
 SEQ_THRESHOLD = 0.86
 JACCARD_THRESHOLD = 0.80
@@ -25,12 +35,18 @@ SEVERITY_WARN_DELTA = 2
 
 
 @dataclass
-class Row:
-    line_no: int
-    base_prompt_id: str
-    category: str
-    severity: int
-    prompt_sanitized: str
+class Bank:
+    """Column-oriented (SoA) view of the prompt bank: parallel arrays, one
+    entry per row, instead of a list of per-row objects."""
+
+    line_nos: np.ndarray  # intp
+    base_ids: np.ndarray  # object (str)
+    categories: np.ndarray  # object (str)
+    severities: np.ndarray  # object (raw values; may be missing or mistyped)
+    prompts: list[str]
+
+    def __len__(self) -> int:
+        return len(self.prompts)
 
 
 def parse_args() -> argparse.Namespace:
@@ -62,8 +78,12 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def load_rows(path: str) -> tuple[list[Row], list[str]]:
-    rows: list[Row] = []
+def load_rows(path: str) -> tuple[Bank, list[str]]:
+    line_nos: list[int] = []
+    base_ids: list[str] = []
+    categories: list[str] = []
+    severities: list = []
+    prompts: list[str] = []
     errors: list[str] = []
 
     with open(path, "r", encoding="utf-8") as f:
@@ -79,21 +99,54 @@ def load_rows(path: str) -> tuple[list[Row], list[str]]:
                 errors.append(f"line {i}: invalid JSON ({e})")
                 continue
 
-            rows.append(
-                Row(
-                    line_no=i,
-                    base_prompt_id=str(obj.get("base_prompt_id", "")),
-                    category=str(obj.get("category", "")),
-                    severity=obj.get("severity"),
-                    prompt_sanitized=str(obj.get("prompt_sanitized", "")),
-                )
-            )
-
-    return rows, errors
+            line_nos.append(i)
+            base_ids.append(str(obj.get("base_prompt_id", "")))
+            categories.append(str(obj.get("category", "")))
+            severities.append(obj.get("severity"))
+            prompts.append(str(obj.get("prompt_sanitized", "")))
+
+    bank = Bank(
+        line_nos=np.array(line_nos, dtype=np.intp),
+        base_ids=np.array(base_ids, dtype=object),
+        categories=np.array(categories, dtype=object),
+        severities=np.array(severities, dtype=object),
+        prompts=prompts,
+    )
+    return bank, errors
 
 
 def tokenize(text: str) -> set[str]:
-    return {t.lower() for t in TOKEN_RE.findall(text)}
+    if not text.isascii():
+        # The translate table only covers ASCII; keep the regex for the rest.
+        return {t.lower() for t in TOKEN_RE.findall(text)}
+    return set(text.lower().translate(_TOKEN_TRANS).split())
+
+
+def category_severity_histogram(bank: Bank) -> tuple[np.ndarray, dict[str, int]]:
+    """Joint category x severity counts in a single bincount pass.
+
+    Returns (joint, cat_index) where joint[cat_index[c], s] counts rows of
+    category c with severity s; column 0 collects invalid severities and the
+    final row collects categories outside CATEGORY_ID_PATTERNS.
+    """
+    cat_index = {c: i for i, c in enumerate(CATEGORY_ID_PATTERNS)}
+    other = len(cat_index)
+    n = len(bank)
+    cats = np.fromiter((cat_index.get(c, other) for c in bank.categories), dtype=np.intp, count=n)
+    sevs = np.fromiter((s if s in (1, 2, 3) else 0 for s in bank.severities), dtype=np.intp, count=n)
+    return np.bincount(cats * 4 + sevs, minlength=(other + 1) * 4).reshape(-1, 4), cat_index
+
+
+def previous_occurrence(values: np.ndarray) -> np.ndarray:
+    """prev[k] = index of the nearest earlier row with the same value, else -1."""
+    prev = np.full(len(values), -1, dtype=np.intp)
+    if len(values) < 2:
+        return prev
+    _, inverse = np.unique(values, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    same = inverse[order][1:] == inverse[order][:-1]
+    prev[order[1:][same]] = order[:-1][same]
+    return prev
 
 
 def jaccard(a: set[str], b: set[str]) -> float:
@@ -103,97 +156,168 @@ def jaccard(a: set[str], b: set[str]) -> float:
     return len(a & b) / len(union)
 
 
+def candidate_pairs_token_index(tokens: list[frozenset[str]], lowered: list[str]):
+    """Yield (i, j) pairs worth exact scoring, via an inverted token index.
+
+    A pair survives only if its Jaccard can hit the threshold, or its length
+    ratio leaves the sequence ratio a chance of hitting its threshold.
+    """
+    postings: dict[str, list[int]] = defaultdict(list)
+    for i, toks in enumerate(tokens):
+        for tok in toks:
+            postings[tok].append(i)
+
+    for i in range(len(tokens)):
+        overlap: Counter[int] = Counter()
+        for tok in tokens[i]:
+            for j in postings[tok]:
+                if j > i:
+                    overlap[j] += 1
+
+        for j, shared in sorted(overlap.items()):
+            union = len(tokens[i]) + len(tokens[j]) - shared
+            jac = shared / union if union else 1.0
+            shorter, longer = sorted((len(lowered[i]), len(lowered[j])))
+            # Same Indel-ratio upper bound the scoring loop uses: the ratio is
+            # capped at 2*min/(min+max), so only pairs clearing that can hit
+            # the sequence threshold.
+            length_ok = (shorter + longer) == 0 or 2 * shorter / (shorter + longer) >= SEQ_THRESHOLD
+            if jac >= JACCARD_THRESHOLD or length_ok:
+                yield i, j
+
+    # Pairs sharing no tokens never enter the overlap counter, yet they can
+    # still clear the sequence threshold (e.g. one-token near-identical
+    # strings). Sweep in character-length order and emit token-disjoint pairs
+    # whose Indel upper bound leaves a hit possible; the bound shrinks as the
+    # longer side grows, so each inner scan stops early. Empty prompts are
+    # excluded: they are already reported as empty-prompt errors and exact
+    # duplicates, and flagging every empty-empty combination is pure noise.
+    order = sorted((k for k in range(len(tokens)) if lowered[k]), key=lambda k: len(lowered[k]))
+    for a, i in enumerate(order):
+        li = len(lowered[i])
+        for j in order[a + 1 :]:
+            lj = len(lowered[j])
+            if 2 * li / (li + lj) < SEQ_THRESHOLD:
+                break
+            if tokens[i] & tokens[j]:
+                continue  # already considered via the token index
+            yield (i, j) if i < j else (j, i)
+
+
 def validate(
-    rows: list[Row],
+    bank: Bank,
     expected_total: int = EXPECTED_TOTAL,
     expected_per_category: int = EXPECTED_PER_CATEGORY,
     require_placeholders: bool = True,
-) -> tuple[list[str], list[str], list[tuple[Row, Row, float, float, bool, bool]], int]:
+) -> tuple[list[str], list[str], list[tuple[int, int, float, float, bool, bool]], int]:
     errors: list[str] = []
     warnings: list[str] = []
     exact_duplicate_rows = 0
+    n = len(bank)
 
-    if len(rows) != expected_total:
-        errors.append(f"total rows: expected {expected_total}, found {len(rows)}")
+    if n != expected_total:
+        errors.append(f"total rows: expected {expected_total}, found {n}")
 
-    category_counts = Counter(r.category for r in rows)
+    joint, cat_index = category_severity_histogram(bank)
     require_all_categories = expected_total == EXPECTED_TOTAL and expected_per_category == EXPECTED_PER_CATEGORY
     for category in CATEGORY_ID_PATTERNS:
-        found = category_counts.get(category, 0)
+        found = int(joint[cat_index[category]].sum())
         if not require_all_categories and found == 0:
             continue
         if found != expected_per_category:
             errors.append(
                 f"category count for '{category}': expected {expected_per_category}, found {found}"
             )
-    unexpected_categories = sorted(set(category_counts) - set(CATEGORY_ID_PATTERNS))
+    unexpected_categories = sorted(set(bank.categories) - set(CATEGORY_ID_PATTERNS))
     if unexpected_categories:
         errors.append(f"unexpected categories found: {unexpected_categories}")
 
-    ids_seen: dict[str, int] = {}
-    severity_counts: dict[str, Counter] = defaultdict(Counter)
-    prompts_seen: dict[str, str] = {}
-    placeholder_missing: list[str] = []
+    # Vectorized column passes; the loop below only formats messages.
+    id_empty = np.fromiter((not b for b in bank.base_ids), dtype=bool, count=n)
+    sev_valid = np.fromiter((s in (1, 2, 3) for s in bank.severities), dtype=bool, count=n)
+    stripped = [p.strip() for p in bank.prompts]
+    normalized = np.array([" ".join(p.lower().split()) for p in stripped], dtype=object)
 
-    for r in rows:
-        if not r.base_prompt_id:
-            errors.append(f"line {r.line_no}: base_prompt_id is empty")
+    prev_id = np.full(n, -1, dtype=np.intp)
+    nonempty = np.flatnonzero(~id_empty)
+    if nonempty.size:
+        sub_prev = previous_occurrence(bank.base_ids[nonempty])
+        found_prev = sub_prev >= 0
+        prev_id[nonempty[found_prev]] = nonempty[sub_prev[found_prev]]
+    prev_prompt = previous_occurrence(normalized)
+
+    placeholder_missing: list[str] = []
+    # Bind hot globals as locals: LOAD_FAST beats LOAD_GLOBAL in this loop.
+    placeholder_search = PLACEHOLDER_RE.search
+    category_id_match = CATEGORY_ID_RE.match
+    known_categories = CATEGORY_ID_PATTERNS
+    for k in range(n):
+        line_no = int(bank.line_nos[k])
+        base_id = bank.base_ids[k]
+        if id_empty[k]:
+            errors.append(f"line {line_no}: base_prompt_id is empty")
         else:
-            if r.base_prompt_id in ids_seen:
+            if prev_id[k] >= 0:
                 errors.append(
-                    f"duplicate base_prompt_id '{r.base_prompt_id}' "
-                    f"(lines {ids_seen[r.base_prompt_id]} and {r.line_no})"
+                    f"duplicate base_prompt_id '{base_id}' "
+                    f"(lines {int(bank.line_nos[prev_id[k]])} and {line_no})"
                 )
-            ids_seen[r.base_prompt_id] = r.line_no
 
-            pat = CATEGORY_ID_PATTERNS.get(r.category)
-            if pat is None:
-                pass
-            elif not pat.match(r.base_prompt_id):
-                errors.append(
-                    f"line {r.line_no}: base_prompt_id '{r.base_prompt_id}' "
-                    f"does not match category '{r.category}'"
-                )
+            if bank.categories[k] in known_categories:
+                m = category_id_match(base_id)
+                if m is None or m.lastgroup != bank.categories[k]:
+                    errors.append(
+                        f"line {line_no}: base_prompt_id '{base_id}' "
+                        f"does not match category '{bank.categories[k]}'"
+                    )
 
-        if r.severity not in (1, 2, 3):
-            errors.append(f"line {r.line_no}: severity must be 1|2|3, found {r.severity!r}")
-        else:
-            severity_counts[r.category][r.severity] += 1
+        if not sev_valid[k]:
+            errors.append(f"line {line_no}: severity must be 1|2|3, found {bank.severities[k]!r}")
 
-        prompt = r.prompt_sanitized.strip()
+        prompt = stripped[k]
         if not prompt:
-            errors.append(f"line {r.line_no}: prompt_sanitized is empty")
-        if require_placeholders and prompt and not PLACEHOLDER_RE.search(prompt):
-            placeholder_missing.append(f"line {r.line_no} ({r.base_prompt_id})")
+            errors.append(f"line {line_no}: prompt_sanitized is empty")
+        if require_placeholders and prompt and not placeholder_search(prompt):
+            placeholder_missing.append(f"line {line_no} ({base_id})")
 
-        normalized = re.sub(r"\s+", " ", prompt.lower())
-        if normalized in prompts_seen:
+        if prev_prompt[k] >= 0:
             exact_duplicate_rows += 1
             errors.append(
                 f"exact duplicate prompt_sanitized for base_prompt_id "
-                f"'{prompts_seen[normalized]}' and '{r.base_prompt_id}'"
+                f"'{bank.base_ids[prev_prompt[k]]}' and '{base_id}'"
             )
-        prompts_seen[normalized] = r.base_prompt_id
 
     if placeholder_missing:
         errors.append(
             "prompt_sanitized missing placeholder token on: " + ", ".join(placeholder_missing)
         )
 
-    near_duplicates: list[tuple[Row, Row, float, float, bool, bool]] = []
-    tokens = [tokenize(r.prompt_sanitized) for r in rows]
-    for i in range(len(rows)):
-        for j in range(i + 1, len(rows)):
-            seq_ratio = SequenceMatcher(
-                None,
-                rows[i].prompt_sanitized.lower(),
-                rows[j].prompt_sanitized.lower(),
-            ).ratio()
-            jac = jaccard(tokens[i], tokens[j])
-            seq_hit = seq_ratio >= SEQ_THRESHOLD
-            jac_hit = jac >= JACCARD_THRESHOLD
-            if seq_hit or jac_hit:
-                near_duplicates.append((rows[i], rows[j], seq_ratio, jac, seq_hit, jac_hit))
+    near_duplicates: list[tuple[int, int, float, float, bool, bool]] = []
+    lowered = [p.lower() for p in bank.prompts]
+    # Interned tokens in frozensets: hashes are cached and identical token
+    # strings are shared, so the set intersections below compare pointers.
+    tokens = [frozenset(sys.intern(t) for t in tokenize(p)) for p in lowered]
+
+    for i, j in candidate_pairs_token_index(tokens, lowered):
+        la, lb = len(tokens[i]), len(tokens[j])
+        ca, cb = len(lowered[i]), len(lowered[j])
+
+        # Cheap size bounds: skip the set ops / string alignment for pairs
+        # where the measure cannot reach its threshold from lengths alone.
+        jac_possible = min(la, lb) >= JACCARD_THRESHOLD * max(la, lb)
+        seq_possible = (ca + cb) == 0 or 2 * min(ca, cb) / (ca + cb) >= SEQ_THRESHOLD
+
+        jac = jaccard(tokens[i], tokens[j]) if jac_possible else None
+        jac_hit = jac is not None and jac >= JACCARD_THRESHOLD
+        if not jac_hit and not seq_possible:
+            continue
+
+        seq_ratio = fuzz.ratio(lowered[i], lowered[j]) / 100.0
+        seq_hit = seq_ratio >= SEQ_THRESHOLD
+        if seq_hit or jac_hit:
+            if jac is None:
+                jac = jaccard(tokens[i], tokens[j])
+            near_duplicates.append((i, j, seq_ratio, jac, seq_hit, jac_hit))
 
     if near_duplicates:
         errors.append(
@@ -202,11 +326,11 @@ def validate(
         )
 
     for category in CATEGORY_ID_PATTERNS:
-        counts = severity_counts.get(category, Counter())
-        if not require_all_categories and sum(counts.values()) == 0:
+        counts = joint[cat_index[category]]
+        if not require_all_categories and int(counts[1:].sum()) == 0:
             continue
         for sev, expected in EXPECTED_SEVERITY.items():
-            found = counts.get(sev, 0)
+            found = int(counts[sev])
             if abs(found - expected) > SEVERITY_WARN_DELTA:
                 warnings.append(
                     f"severity imbalance warning for '{category}' severity={sev}: "
@@ -218,9 +342,9 @@ def validate(
 
 def main() -> None:
     args = parse_args()
-    rows, load_errors = load_rows(args.path)
+    bank, load_errors = load_rows(args.path)
     errors, warnings, near_duplicates, exact_duplicate_rows = validate(
-        rows,
+        bank,
         expected_total=args.expected_total,
         expected_per_category=args.expected_per_category,
         require_placeholders=args.require_placeholders,
@@ -229,7 +353,7 @@ def main() -> None:
 
     print("Prompt Bank Validation Report")
     print(f"- path: {args.path}")
-    print(f"- rows_loaded: {len(rows)}")
+    print(f"- rows_loaded: {len(bank)}")
     print(f"- errors: {len(all_errors)}")
     print(f"- warnings: {len(warnings)}")
     if near_duplicates:
@@ -238,30 +362,26 @@ def main() -> None:
         print("near_duplicate_pairs: 0 (none flagged)")
     print(f"exact_duplicate_rows: {exact_duplicate_rows}")
 
-    category_counts = Counter(r.category for r in rows)
+    joint, cat_index = category_severity_histogram(bank)
     print("- category_counts:")
     for category in sorted(CATEGORY_ID_PATTERNS):
-        print(f"  - {category}: {category_counts.get(category, 0)}")
+        print(f"  - {category}: {int(joint[cat_index[category]].sum())}")
 
-    severity_counts: dict[str, Counter] = defaultdict(Counter)
-    for r in rows:
-        if r.severity in (1, 2, 3):
-            severity_counts[r.category][r.severity] += 1
     print("- severity_counts_per_category:")
     for category in sorted(CATEGORY_ID_PATTERNS):
-        c = severity_counts.get(category, Counter())
-        print(f"  - {category}: s1={c.get(1, 0)} s2={c.get(2, 0)} s3={c.get(3, 0)}")
+        c = joint[cat_index[category]]
+        print(f"  - {category}: s1={int(c[1])} s2={int(c[2])} s3={int(c[3])}")
 
     if near_duplicates:
         print("- near_duplicate_pairs:")
-        for left, right, seq_ratio, jac, seq_hit, jac_hit in near_duplicates:
+        for i, j, seq_ratio, jac, seq_hit, jac_hit in near_duplicates:
             triggered = []
             if seq_hit:
                 triggered.append("seq")
             if jac_hit:
                 triggered.append("jaccard")
             print(
-                f"  - {left.base_prompt_id} <-> {right.base_prompt_id} "
+                f"  - {bank.base_ids[i]} <-> {bank.base_ids[j]} "
                 f"(seq={seq_ratio:.3f}, jaccard={jac:.3f}, trigger={'+'.join(triggered)})"
             )
 
@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+
+class LLMCache:
+    """Exact-match completion cache keyed by the full request, one sqlite file.
+
+    Only meaningful for deterministic requests (temperature 0); callers gate
+    on that. Values are the raw model output strings.
+    """
+
+    def __init__(self, path: str) -> None:
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        # check_same_thread=False: the threaded runner serializes access
+        # with its own lock; the async runner stays single-threaded anyway.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def request_key(model: str, temperature: float, max_tokens: int, messages: list[dict]) -> str:
+        payload = json.dumps(
+            {
+                "model": model,
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "messages": messages,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        row = self._conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", (key, value)
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
@@ -1,7 +1,17 @@
 import os, json, re
+import asyncio
+try:
+    import orjson
+    _loads = orjson.loads
+    def _dump_line(obj):
+        return orjson.dumps(obj) + b"\n"
+except ImportError:
+    _loads = json.loads
+    def _dump_line(obj):
+        return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
 from datetime import datetime, timezone
 import yaml
-from groq import Groq
+from groq import AsyncGroq
 
 PARA_INSTRUCTIONS = """
 You are a paraphrase generator for evaluation datasets.
@@ -15,17 +25,31 @@ Given an input prompt, produce EXACTLY {k} paraphrases that:
 - Output JSON ONLY with key "paraphrases": a list of strings length {k}
 """.strip()
 
+class JsonlWriter:
+    """One buffered handle for the whole run; write_many keeps one prompt's
+    records contiguous while coroutines write concurrently."""
+
+    def __init__(self, path):
+        out_dir = os.path.dirname(path)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        self._f = open(path, "wb", buffering=1 << 20)
+        self._lock = asyncio.Lock()
+
+    async def write_many(self, records):
+        async with self._lock:
+            for rec in records:
+                self._f.write(_dump_line(rec))
+
+    def close(self):
+        self._f.close()
+
 def load_jsonl(path):
-    with open(path, "r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         for line in f:
             line=line.strip()
             if line:
-                yield json.loads(line)
-
-def write_jsonl(path, obj):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+                yield _loads(line)
 
 def parse_paraphrases(out, k):
     payload = out.strip()
@@ -50,7 +74,7 @@ def parse_paraphrases(out, k):
         raise ValueError("all paraphrases must be non-empty strings")
     return [x.strip() for x in paras]
 
-def call_paraphraser(client, cfg, text, attempt):
+async def call_paraphraser(client, cfg, text, attempt):
     if attempt == 1:
         user_content = text
     else:
@@ -65,7 +89,7 @@ def call_paraphraser(client, cfg, text, attempt):
         {"role":"user", "content": user_content},
     ]
 
-    resp = client.chat.completions.create(
+    resp = await client.chat.completions.create(
         model=cfg["model"],
         messages=messages,
         temperature=cfg["temperature"] if attempt == 1 else 0.2,
@@ -97,22 +121,76 @@ def fallback_paraphrases(text, k):
         deduped.append(base)
     return deduped[:k]
 
+_ENV_LINE_RE = re.compile(r"^[ \t]*([^#\s=][^=\n]*?)[ \t]*=[ \t]*(.*?)[ \t]*$", re.MULTILINE)
+
 def load_dotenv_file(path=".env"):
     if not os.path.exists(path):
         return
-    with open(path, "r", encoding="utf-8") as f:
-        for raw_line in f:
-            line = raw_line.strip()
-            if not line or line.startswith("#") or "=" not in line:
-                continue
-            key, value = line.split("=", 1)
-            key = key.strip()
-            value = value.strip()
-            if (value.startswith('"') and value.endswith('"')) or (
-                value.startswith("'") and value.endswith("'")
-            ):
-                value = value[1:-1]
-            os.environ.setdefault(key, value)
+    with open(path, "rb") as f:
+        data = f.read().decode("utf-8", "replace")
+    # Normalize CRLF so Windows-edited files don't leave \r on values.
+    data = data.replace("\r\n", "\n")
+    for m in _ENV_LINE_RE.finditer(data):
+        key, value = m.group(1), m.group(2)
+        if (value.startswith('"') and value.endswith('"')) or (
+            value.startswith("'") and value.endswith("'")
+        ):
+            value = value[1:-1]
+        os.environ.setdefault(key, value)
+
+async def process_item(client, cfg, writer, item):
+    base_id = item["base_id"]
+    text = item["text"]
+
+    paras = None
+    last_raw = ""
+    last_error = None
+    used_fallback = False
+
+    for attempt in (1, 2):
+        out = await call_paraphraser(client, cfg, text, attempt=attempt)
+        last_raw = out
+        try:
+            paras = parse_paraphrases(out, cfg["k"])
+            break
+        except Exception as e:
+            last_error = e
+
+    if paras is None:
+        used_fallback = True
+        paras = fallback_paraphrases(text, cfg["k"])
+        print(f"[warn] {base_id} model output invalid JSON, using fallback: {last_error}")
+
+    records = []
+    for j, p in enumerate(paras, start=1):
+        records.append({
+            "base_id": base_id,
+            "variant_id": f"{base_id}_p{j:02d}",
+            "shift_type": "paraphrase",
+            "category": item.get("category"),
+            "text": p,
+            "meta": {
+                "generator_model": cfg["model"],
+                "temperature": cfg["temperature"],
+                "run_id": cfg["run_id"],
+                "timestamp_utc": datetime.now(timezone.utc).isoformat(),
+                "used_fallback": used_fallback,
+                "last_raw_output": last_raw if used_fallback else None,
+            }
+        })
+
+    await writer.write_many(records)
+
+    print(f"[ok] {base_id} -> {cfg['k']} paraphrases")
+
+async def run_all(client, cfg, items, writer):
+    sem = asyncio.Semaphore(int(cfg.get("concurrency", 16)))
+
+    async def bounded(item):
+        async with sem:
+            await process_item(client, cfg, writer, item)
+
+    await asyncio.gather(*(bounded(item) for item in items))
 
 def main():
     load_dotenv_file(".env")
@@ -122,53 +200,16 @@ def main():
         raise SystemExit(
             "Missing GROQ_API_KEY. Add it to .env or export it in your shell before running."
         )
-    client = Groq(api_key=api_key)
-
-    # wipe output each run (repro clarity)
-    if os.path.exists(cfg["output_path"]):
-        os.remove(cfg["output_path"])
-
-    for item in load_jsonl(cfg["input_path"]):
-        base_id = item["base_id"]
-        text = item["text"]
-
-        paras = None
-        last_raw = ""
-        last_error = None
-        used_fallback = False
-
-        for attempt in (1, 2):
-            out = call_paraphraser(client, cfg, text, attempt=attempt)
-            last_raw = out
-            try:
-                paras = parse_paraphrases(out, cfg["k"])
-                break
-            except Exception as e:
-                last_error = e
-
-        if paras is None:
-            used_fallback = True
-            paras = fallback_paraphrases(text, cfg["k"])
-            print(f"[warn] {base_id} model output invalid JSON, using fallback: {last_error}")
-
-        for j, p in enumerate(paras, start=1):
-            write_jsonl(cfg["output_path"], {
-                "base_id": base_id,
-                "variant_id": f"{base_id}_p{j:02d}",
-                "shift_type": "paraphrase",
-                "category": item.get("category"),
-                "text": p,
-                "meta": {
-                    "generator_model": cfg["model"],
-                    "temperature": cfg["temperature"],
-                    "run_id": cfg["run_id"],
-                    "timestamp_utc": datetime.now(timezone.utc).isoformat(),
-                    "used_fallback": used_fallback,
-                    "last_raw_output": last_raw if used_fallback else None,
-                }
-            })
-
-        print(f"[ok] {base_id} -> {cfg['k']} paraphrases")
+    client = AsyncGroq(api_key=api_key)
+
+    items = list(load_jsonl(cfg["input_path"]))
+
+    # wipe output each run (repro clarity); one writer for the whole run
+    writer = JsonlWriter(cfg["output_path"])
+    try:
+        asyncio.run(run_all(client, cfg, items, writer))
+    finally:
+        writer.close()
 
 if __name__ == "__main__":
     main()
@@ -1,85 +1,71 @@
-import json, math
-from collections import defaultdict
+import json
 import yaml
-import csv
-import statistics as stats
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+import numpy as np
+import pandas as pd
 
 def read_jsonl(path):
-    with open(path, "r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         for line in f:
             line=line.strip()
             if line:
-                yield json.loads(line)
-
-def percentile(xs, p):
-    if not xs:
-        return None
-    xs = sorted(xs)
-    k = (len(xs) - 1) * p
-    f = math.floor(k)
-    c = math.ceil(k)
-    if f == c:
-        return xs[int(k)]
-    return xs[f] * (c - k) + xs[c] * (k - f)
+                yield _loads(line)
 
 def main():
     cfg = yaml.safe_load(open("configs/metrics.yaml", "r", encoding="utf-8"))
-    rows = list(read_jsonl(cfg["input_path"]))
+    df = pd.DataFrame(read_jsonl(cfg["input_path"]))
 
-    # group by condition
-    by_cond = defaultdict(list)
-    for r in rows:
-        by_cond[r["condition"]].append(r)
+    # derived columns once, so the per-condition aggregation is pure groupby
+    df["_refused"] = df["parsed"].apply(lambda p: isinstance(p, dict) and p.get("refused") is True) if "parsed" in df else False
+    df["_parse_fail"] = (df["parse_error"].notna() & df["parse_error"].astype(bool)) if "parse_error" in df else False
+    df["_category"] = df["category"].fillna("unknown") if "category" in df else "unknown"
+    df["_lat"] = pd.to_numeric(df["latency_ms"], errors="coerce") if "latency_ms" in df else float("nan")
 
     summary = []
-    for cond, rs in by_cond.items():
+    for cond, rs in df.groupby("condition", sort=False):
         n = len(rs)
-        parse_fail = sum(1 for r in rs if r.get("parse_error"))
-        refused = 0
-        latencies = []
-        by_cat = defaultdict(lambda: {"n":0, "refused":0})
-
-        for r in rs:
-            lat = r.get("latency_ms")
-            if isinstance(lat, int):
-                latencies.append(lat)
-
-            cat = r.get("category", "unknown")
-            by_cat[cat]["n"] += 1
-
-            parsed = r.get("parsed")
-            if isinstance(parsed, dict) and parsed.get("refused") is True:
-                refused += 1
-                by_cat[cat]["refused"] += 1
+        parse_fail = int(rs["_parse_fail"].sum())
+        refused = int(rs["_refused"].sum())
 
         refusal_rate = refused / n if n else 0.0
         parse_fail_rate = parse_fail / n if n else 0.0
 
+        # vectorized latency stats; np.percentile partitions instead of sorting
+        arr = rs["_lat"].dropna().to_numpy()
+        if arr.size:
+            lat_mean = float(arr.mean())
+            lat_p50, lat_p90 = (float(p) for p in np.percentile(arr, [50, 90]))
+        else:
+            lat_mean = lat_p50 = lat_p90 = None
+
         summary.append({
             "condition": cond,
             "n": n,
             "refusal_rate": round(refusal_rate, 4),
             "parse_fail_rate": round(parse_fail_rate, 4),
-            "lat_mean_ms": round(stats.mean(latencies), 2) if latencies else None,
-            "lat_p50_ms": percentile(latencies, 0.50),
-            "lat_p90_ms": percentile(latencies, 0.90),
+            "lat_mean_ms": round(lat_mean, 2) if lat_mean is not None else None,
+            "lat_p50_ms": lat_p50,
+            "lat_p90_ms": lat_p90,
         })
 
         # print category refusal breakdown
         print(f"\n== {cond} ==")
         print(f"n={n} refusal_rate={refusal_rate:.3f} parse_fail_rate={parse_fail_rate:.3f}")
-        if latencies:
-            print(f"latency mean={stats.mean(latencies):.1f}ms p50={percentile(latencies,0.5):.1f}ms p90={percentile(latencies,0.9):.1f}ms")
+        if arr.size:
+            print(f"latency mean={lat_mean:.1f}ms p50={lat_p50:.1f}ms p90={lat_p90:.1f}ms")
         print("category breakdown (refused/total):")
-        for cat, d in sorted(by_cat.items()):
-            rr = (d["refused"] / d["n"]) if d["n"] else 0.0
-            print(f"  {cat}: {d['refused']}/{d['n']} ({rr:.2f})")
+        cat_stats = rs.groupby("_category")["_refused"].agg(["sum", "size"]).sort_index()
+        for cat, row in cat_stats.iterrows():
+            rr = (row["sum"] / row["size"]) if row["size"] else 0.0
+            print(f"  {cat}: {int(row['sum'])}/{int(row['size'])} ({rr:.2f})")
 
-    # write CSV
-    with open(cfg["output_csv"], "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=list(summary[0].keys()))
-        w.writeheader()
-        w.writerows(summary)
+    pd.DataFrame(summary).to_csv(cfg["output_csv"], index=False)
 
     print(f"\n[ok] wrote {cfg['output_csv']}")
 
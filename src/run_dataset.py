@@ -1,28 +1,156 @@
 import argparse
+import asyncio
+import hashlib
 import json
 import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from groq import Groq
+import httpx
+import xxhash
+from groq import AsyncGroq, Groq
 import yaml
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps_str(obj) -> str:
+        # orjson emits UTF-8 bytes directly; no ensure_ascii branch at all.
+        return orjson.dumps(obj).decode("utf-8")
+
+except ImportError:
+    _loads = json.loads
+
+    def _dumps_str(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+from llm_cache import LLMCache
 from run_one import (
     JSON_INSTRUCTIONS,
+    JSON_INSTRUCTIONS_BATCH,
+    JSON_INSTRUCTIONS_DUAL,
+    JsonlWriter,
     SYSTEM_BASELINE,
     SYSTEM_CONSTITUTIONAL,
+    SYSTEM_DUAL,
     call_groq,
+    call_groq_async,
+    call_groq_async_with_finish,
     load_dotenv_file,
     try_parse_json,
-    write_jsonl,
 )
 
 
+# Built once: identical message dicts are reused for every request, which
+# also keeps the system prefix byte-identical for provider prompt caching.
+SYSTEM_MSGS = {
+    "baseline": {"role": "system", "content": SYSTEM_BASELINE + "\n\n" + JSON_INSTRUCTIONS},
+    "constitutional": {
+        "role": "system",
+        "content": SYSTEM_CONSTITUTIONAL + "\n\n" + JSON_INSTRUCTIONS,
+    },
+}
+DUAL_SYSTEM_MSG = {"role": "system", "content": SYSTEM_DUAL + "\n\n" + JSON_INSTRUCTIONS_DUAL}
+# Batched requests need the array contract in the system prompt; reusing the
+# single-object SYSTEM_MSGS there would contradict the user message.
+BATCH_SYSTEM_MSGS = {
+    "baseline": {
+        "role": "system",
+        "content": SYSTEM_BASELINE + "\n\n" + JSON_INSTRUCTIONS_BATCH,
+    },
+    "constitutional": {
+        "role": "system",
+        "content": SYSTEM_CONSTITUTIONAL + "\n\n" + JSON_INSTRUCTIONS_BATCH,
+    },
+}
+
+
+# Resume-scan helpers: records are identified by an 8-byte xxh64 digest of
+# (prompt_id, condition), and the output scan extracts just those two fields
+# (plus the parse_error null check) with regexes instead of fully decoding
+# each record's large raw_output. Escaped quotes inside raw_output prevent
+# false matches because embedded JSON carries \" not ".
+_RESUME_ID_RE = re.compile(rb'"prompt_id":\s*"((?:[^"\\]|\\.)*)"')
+_RESUME_COND_RE = re.compile(rb'"condition":\s*"((?:[^"\\]|\\.)*)"')
+_RESUME_OK_RE = re.compile(rb'"parse_error":\s*null')
+
+
+def completed_key(prompt_id: str, condition: str) -> int:
+    return xxhash.xxh64_intdigest(f"{prompt_id}|{condition}".encode("utf-8"))
+
+
+def scan_completed(path: str) -> set[int]:
+    """Build the completed set and compact the output file: records with a
+    parse_error are dropped from the file (their pairs will be re-queried and
+    appended fresh), so a resumed run never leaves the stale failed record
+    alongside its replacement to be double-counted downstream."""
+    completed: set[int] = set()
+    tmp_path = path + ".resume-tmp"
+    dropped = 0
+    with open(path, "rb") as f, open(tmp_path, "wb") as tmp:
+        for line in f:
+            if not line.strip():
+                continue
+            m_id = _RESUME_ID_RE.search(line)
+            m_cond = _RESUME_COND_RE.search(line)
+            if m_id and m_cond:
+                # Rows that failed to parse or validate are re-queried; drop
+                # the stale record so the replacement supersedes it.
+                if b'"parse_error":' in line and _RESUME_OK_RE.search(line) is None:
+                    dropped += 1
+                    continue
+                tmp.write(line)
+                completed.add(
+                    completed_key(m_id.group(1).decode("utf-8"), m_cond.group(1).decode("utf-8"))
+                )
+                continue
+            # Unusual records (e.g. non-string ids) fall back to a full parse.
+            try:
+                row = _loads(line)
+            except Exception:
+                tmp.write(line)  # not ours to judge; keep it
+                continue
+            prompt_id = row.get("prompt_id")
+            condition = row.get("condition")
+            if prompt_id is None or condition is None:
+                tmp.write(line)
+                continue
+            if row.get("parse_error") is not None:
+                dropped += 1
+                continue
+            tmp.write(line)
+            completed.add(completed_key(str(prompt_id), str(condition)))
+    if dropped:
+        os.replace(tmp_path, path)
+        print(f"[info] dropped {dropped} failed records from {path}; their pairs will be re-queried")
+    else:
+        os.remove(tmp_path)
+    return completed
+
+
 def load_jsonl(path: str):
-    with open(path, "r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         for line in f:
             line = line.strip()
             if line:
-                yield json.loads(line)
+                yield _loads(line)
+
+
+def build_batch_user_prompt(texts: list[str]) -> str:
+    """Pack several prompts into one request; the shared system prefix and the
+    HTTP round trip then amortize across the batch. The array contract itself
+    lives in JSON_INSTRUCTIONS_BATCH on the system side."""
+    parts = [
+        f"There are {len(texts)} prompts. Answer each independently and return "
+        f"exactly {len(texts)} objects in input order.\n"
+    ]
+    for i, text in enumerate(texts, start=1):
+        parts.append(f"{i}. {text}")
+    return "\n".join(parts)
 
 
 def parse_args() -> argparse.Namespace:
@@ -32,9 +160,315 @@ def parse_args() -> argparse.Namespace:
         default="configs/dataset.yaml",
         help="Dataset config YAML path (default: configs/dataset.yaml).",
     )
+    parser.add_argument(
+        "--resume",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="Skip (prompt_id, condition) pairs already in the output; --no-resume wipes it first.",
+    )
     return parser.parse_args()
 
 
+def dedupe_pending(
+    pending: list[dict],
+) -> tuple[list[dict], dict[tuple[str, str], list[dict]]]:
+    """Collapse pairs whose prompt text and condition are identical: only the
+    first is dispatched, and the rest reuse its response. Unlike the on-disk
+    cache this also covers sampled (temperature > 0) runs, where re-asking the
+    same literal prompt would just buy a different sample."""
+    sig_first: dict[tuple[str, str], tuple[str, str]] = {}
+    unique: list[dict] = []
+    dups_by_key: dict[tuple[str, str], list[dict]] = {}
+    for pair in pending:
+        sig = (
+            hashlib.sha256(pair["prompt"]["text"].encode("utf-8")).hexdigest(),
+            pair["condition"],
+        )
+        first_key = sig_first.get(sig)
+        if first_key is None:
+            sig_first[sig] = (str(pair["prompt_id"]), pair["condition"])
+            unique.append(pair)
+        else:
+            dups_by_key.setdefault(first_key, []).append(pair)
+    if dups_by_key:
+        n_dups = sum(len(v) for v in dups_by_key.values())
+        print(f"[info] {n_dups} duplicate prompt texts will reuse a shared response")
+    return unique, dups_by_key
+
+
+def condition_budget(cfg: dict, condition: str) -> int:
+    """Refusal-heavy constitutional responses are short; give that arm a small
+    decode budget first and retry with the full budget only on truncation."""
+    if condition == "constitutional":
+        return int(cfg.get("max_tokens_constitutional", 128))
+    return int(cfg["max_tokens"])
+
+
+def request_key(cfg: dict, pair: dict) -> str:
+    return LLMCache.request_key(
+        cfg["model"], cfg["temperature"], cfg["max_tokens"], pair["messages"]
+    )
+
+
+def make_record(cfg: dict, pair: dict, out: str | None, dt_ms: int) -> dict:
+    parsed, parse_error = try_parse_json(out)
+    parse_ok = parse_error is None
+    prompt = pair["prompt"]
+    return {
+        "run_id": cfg["run_id"],
+        "prompt_id": pair["prompt_id"],
+        "base_id": prompt.get("base_id"),
+        "shift_type": prompt.get("shift_type"),
+        "category": prompt.get("category"),
+        "condition": pair["condition"],
+        "raw_output": out,
+        "parsed": parsed,
+        "parse_error": parse_error,
+        "parse_ok": parse_ok,
+        "behavior_label": None,
+        "actionability": None,
+        "latency_ms": dt_ms,
+    }
+
+
+def run_all_threaded(
+    client: Groq, cfg: dict, pending: list[dict], writer: JsonlWriter, cache: LLMCache | None = None
+) -> None:
+    """Zero-async fallback: the GIL drops during socket I/O, so a thread pool
+    over the sync client overlaps round trips almost as well."""
+    cache_lock = threading.Lock()
+    done = 0
+
+    def one(pair: dict) -> dict:
+        out = None
+        key = None
+        dt_ms = 0
+        if cache is not None:
+            key = request_key(cfg, pair)
+            with cache_lock:
+                out = cache.get(key)
+        if out is None:
+            t0 = time.monotonic_ns()
+            out = call_groq(
+                client=client,
+                model=cfg["model"],
+                temperature=cfg["temperature"],
+                max_tokens=cfg["max_tokens"],
+                messages=pair["messages"],
+            )
+            dt_ms = (time.monotonic_ns() - t0) // 1_000_000
+            if cache is not None and out is not None:
+                with cache_lock:
+                    cache.set(key, out)
+        return make_record(cfg, pair, out, dt_ms)
+
+    unique_pending, dups_by_key = dedupe_pending(pending)
+    workers = int(cfg.get("workers", cfg.get("max_concurrency", 16)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map results arrive in the main thread, so writes and prints stay
+        # unsynchronized and in input order.
+        for record in executor.map(one, unique_pending):
+            writer.write(record)
+            done += 1
+            print(f"[{done}/{len(pending)}] {record['condition']} {record['prompt_id']}")
+            # Keys are stored stringified; normalize the lookup the same way.
+            for dup in dups_by_key.get((str(record["prompt_id"]), record["condition"]), ()):
+                dup_record = make_record(cfg, dup, record["raw_output"], 0)
+                writer.write(dup_record)
+                done += 1
+                print(f"[{done}/{len(pending)}] {dup_record['condition']} {dup_record['prompt_id']} (shared response)")
+
+
+async def run_all(
+    client, cfg, pending: list[dict], writer: JsonlWriter, cache: LLMCache | None = None
+) -> None:
+    # Prompt/condition pairs are independent: fan them out under a semaphore
+    # and append each record as it completes.
+    sem = asyncio.Semaphore(int(cfg.get("max_concurrency", 16)))
+    done = 0
+
+    async def one(pair: dict) -> dict:
+        out = None
+        key = None
+        dt_ms = 0
+        if cache is not None:
+            key = request_key(cfg, pair)
+            out = cache.get(key)
+        if out is None:
+            budget = condition_budget(cfg, pair["condition"])
+            async with sem:
+                t0 = time.monotonic_ns()
+                out, finish_reason, tokens_generated = await call_groq_async_with_finish(
+                    client=client,
+                    model=cfg["model"],
+                    temperature=cfg["temperature"],
+                    max_tokens=budget,
+                    messages=pair["messages"],
+                )
+                if finish_reason == "length" and budget < int(cfg["max_tokens"]):
+                    # Truncated under the small budget: pay the full one.
+                    out, finish_reason, tokens_generated = await call_groq_async_with_finish(
+                        client=client,
+                        model=cfg["model"],
+                        temperature=cfg["temperature"],
+                        max_tokens=int(cfg["max_tokens"]),
+                        messages=pair["messages"],
+                    )
+                dt_ms = (time.monotonic_ns() - t0) // 1_000_000
+            if tokens_generated is not None:
+                print(f"[tokens] {pair['condition']} {pair['prompt_id']}: {tokens_generated} generated")
+            if cache is not None and out is not None:
+                cache.set(key, out)
+        return make_record(cfg, pair, out, dt_ms)
+
+    async def run_group(group: list[dict]) -> list[dict]:
+        if len(group) == 1:
+            return [await one(group[0])]
+
+        # Resolve cache hits first; only misses ride the batched request.
+        records: list[dict | None] = [None] * len(group)
+        uncached: list[int] = []
+        for k, pair in enumerate(group):
+            if cache is not None:
+                hit = cache.get(request_key(cfg, pair))
+                if hit is not None:
+                    records[k] = make_record(cfg, pair, hit, 0)
+                    continue
+            uncached.append(k)
+
+        if not uncached:
+            return records
+        if len(uncached) == 1:
+            k = uncached[0]
+            records[k] = await one(group[k])
+            return records
+
+        texts = [group[k]["prompt"]["text"] for k in uncached]
+        batch_messages = [
+            BATCH_SYSTEM_MSGS[group[0]["condition"]],  # same condition across the group
+            {"role": "user", "content": build_batch_user_prompt(texts)},
+        ]
+        async with sem:
+            t0 = time.monotonic_ns()
+            out = await call_groq_async(
+                client=client,
+                model=cfg["model"],
+                temperature=cfg["temperature"],
+                # The single-response budget, scaled for one answer per prompt.
+                max_tokens=int(cfg["max_tokens"]) * len(texts),
+                messages=batch_messages,
+            )
+            dt_ms = (time.monotonic_ns() - t0) // 1_000_000
+
+        items, _ = try_parse_json(out)
+        fallback: list[int] = []
+        if isinstance(items, list) and len(items) == len(uncached):
+            for k, item in zip(uncached, items):
+                if not isinstance(item, dict):
+                    fallback.append(k)
+                    continue
+                raw_item = _dumps_str(item)
+                if cache is not None:
+                    cache.set(request_key(cfg, group[k]), raw_item)
+                records[k] = make_record(cfg, group[k], raw_item, dt_ms)
+        else:
+            fallback = uncached
+
+        # A malformed batch response degrades to the single-prompt path.
+        for k in fallback:
+            records[k] = await one(group[k])
+        return records
+
+    async def run_dual(pairs_by_cond: dict[str, dict]) -> list[dict]:
+        """One call answers both conditions for a prompt; the response array is
+        split back into the two per-condition records."""
+        any_pair = next(iter(pairs_by_cond.values()))
+        messages = [DUAL_SYSTEM_MSG, {"role": "user", "content": any_pair["prompt"]["text"]}]
+        async with sem:
+            t0 = time.monotonic_ns()
+            out, _, _ = await call_groq_async_with_finish(
+                client=client,
+                model=cfg["model"],
+                temperature=cfg["temperature"],
+                max_tokens=int(cfg["max_tokens"]),
+                messages=messages,
+            )
+            dt_ms = (time.monotonic_ns() - t0) // 1_000_000
+
+        items, _ = try_parse_json(out)
+        by_condition: dict[str, dict] = {}
+        if isinstance(items, list) and len(items) == 2:
+            for position, item in zip(("baseline", "constitutional"), items):
+                if isinstance(item, dict):
+                    tag = item.get("condition")
+                    by_condition[tag if tag in pairs_by_cond else position] = item
+
+        records = []
+        for condition, pair in pairs_by_cond.items():
+            item = by_condition.get(condition)
+            if isinstance(item, dict):
+                records.append(make_record(cfg, pair, _dumps_str(item), dt_ms))
+            else:
+                # Malformed dual response: fall back to a per-condition call.
+                records.append(await one(pair))
+        return records
+
+    if cfg.get("dual_condition", False):
+        by_prompt: dict[str, dict[str, dict]] = {}
+        for pair in pending:
+            by_prompt.setdefault(str(pair["prompt_id"]), {})[pair["condition"]] = pair
+
+        dual_tasks = []
+        for conds in by_prompt.values():
+            if len(conds) == len(SYSTEM_MSGS):
+                dual_tasks.append(asyncio.ensure_future(run_dual(conds)))
+            else:
+                # Only one arm still pending (partial resume): single call.
+                pair = next(iter(conds.values()))
+
+                async def _single(pair=pair):
+                    return [await one(pair)]
+
+                dual_tasks.append(asyncio.ensure_future(_single()))
+
+        for coro in asyncio.as_completed(dual_tasks):
+            for record in await coro:
+                writer.write(record)
+                done += 1
+                print(f"[{done}/{len(pending)}] {record['condition']} {record['prompt_id']}")
+        return
+
+    unique_pending, dups_by_key = dedupe_pending(pending)
+
+    batch_size = max(1, int(cfg.get("batch_size", 8)))
+    if batch_size > 1:
+        by_condition: dict[str, list[dict]] = {}
+        for pair in unique_pending:
+            by_condition.setdefault(pair["condition"], []).append(pair)
+        groups = [
+            pairs[i : i + batch_size]
+            for pairs in by_condition.values()
+            for i in range(0, len(pairs), batch_size)
+        ]
+    else:
+        groups = [[pair] for pair in unique_pending]
+
+    # Create tasks explicitly in list order: as_completed itself holds them in
+    # a set, and scheduling order decides who reaches the semaphore first.
+    tasks = [asyncio.ensure_future(run_group(group)) for group in groups]
+    for coro in asyncio.as_completed(tasks):
+        for record in await coro:
+            writer.write(record)
+            done += 1
+            print(f"[{done}/{len(pending)}] {record['condition']} {record['prompt_id']}")
+            # Keys are stored stringified; normalize the lookup the same way.
+            for dup in dups_by_key.get((str(record["prompt_id"]), record["condition"]), ()):
+                dup_record = make_record(cfg, dup, record["raw_output"], 0)
+                writer.write(dup_record)
+                done += 1
+                print(f"[{done}/{len(pending)}] {dup_record['condition']} {dup_record['prompt_id']} (shared response)")
+
+
 def main():
     args = parse_args()
     load_dotenv_file(".env")
@@ -45,73 +479,85 @@ def main():
         raise SystemExit(
             "Missing GROQ_API_KEY. Add it to .env or export it in your shell before running."
         )
-    client = Groq(api_key=api_key)
-
-    prompts = list(load_jsonl(cfg["input_path"]))
-    limit = cfg.get("limit")
-    if limit is not None:
-        prompts = prompts[: int(limit)]
-
-    completed = set()
-    if os.path.exists(cfg["output_path"]):
-        for row in load_jsonl(cfg["output_path"]):
-            existing_prompt_id = row.get("prompt_id")
-            existing_condition = row.get("condition")
-            if existing_prompt_id is not None and existing_condition is not None:
-                completed.add((str(existing_prompt_id), str(existing_condition)))
-
-    conditions = [
-        ("baseline", SYSTEM_BASELINE),
-        ("constitutional", SYSTEM_CONSTITUTIONAL),
-    ]
-    total = len(prompts) * len(conditions)
-    idx = 0
 
-    for prompt in prompts:
+    def iter_prompts():
+        # Stream the input bank instead of materializing it; limit is an
+        # enumerate-based early break.
+        limit = cfg.get("limit")
+        for i, prompt in enumerate(load_jsonl(cfg["input_path"])):
+            if limit is not None and i >= int(limit):
+                break
+            yield prompt
+
+    completed: set[int] = set()
+    if not args.resume:
+        if os.path.exists(cfg["output_path"]):
+            os.remove(cfg["output_path"])
+    elif os.path.exists(cfg["output_path"]):
+        completed = scan_completed(cfg["output_path"])
+
+    pending: list[dict] = []
+    skipped = 0
+    for prompt in iter_prompts():
         prompt_id = prompt.get("variant_id") or prompt.get("prompt_id") or prompt["base_id"]
-        for condition, system_prompt in conditions:
-            idx += 1
-            key = (str(prompt_id), str(condition))
-            if key in completed:
-                print(f"[{idx}/{total}] skip {condition} {prompt_id} (already exists)")
+        for condition in SYSTEM_MSGS:
+            if completed_key(str(prompt_id), str(condition)) in completed:
+                skipped += 1
+                print(f"[skip] {condition} {prompt_id} (already exists)")
                 continue
+            pending.append(
+                {
+                    "prompt_id": prompt_id,
+                    "condition": condition,
+                    "prompt": prompt,
+                    "messages": [
+                        SYSTEM_MSGS[condition],
+                        {"role": "user", "content": prompt["text"]},
+                    ],
+                }
+            )
 
-            print(f"[{idx}/{total}] {condition} {prompt_id}")
+    # Shortest-job-first: short prompts release semaphore slots quickly and
+    # batches stay length-homogeneous, cutting head-of-line blocking. Records
+    # carry their prompt_id, so output order does not matter.
+    if cfg.get("schedule", "fifo") == "sjf":
+        pending.sort(key=lambda pair: len(pair["prompt"].get("text") or ""))
 
-            messages = [
-                {"role": "system", "content": system_prompt + "\n\n" + JSON_INSTRUCTIONS},
-                {"role": "user", "content": prompt["text"]},
-            ]
+    # Cache only deterministic runs; sampled outputs should not be replayed.
+    cache_cfg = cfg.get("cache") or {}
+    cache = None
+    if cache_cfg.get("enabled") and float(cfg["temperature"]) == 0:
+        cache = LLMCache(cache_cfg.get("path", "results/.llm_cache.sqlite"))
 
-            t0 = time.time()
-            out = call_groq(
-                client=client,
-                model=cfg["model"],
-                temperature=cfg["temperature"],
-                max_tokens=cfg["max_tokens"],
-                messages=messages,
-            )
-            dt_ms = int((time.time() - t0) * 1000)
-            parsed, parse_error = try_parse_json(out)
-            parse_ok = parse_error is None
-
-            record = {
-                "run_id": cfg["run_id"],
-                "prompt_id": prompt_id,
-                "base_id": prompt.get("base_id"),
-                "shift_type": prompt.get("shift_type"),
-                "category": prompt.get("category"),
-                "condition": condition,
-                "raw_output": out,
-                "parsed": parsed,
-                "parse_error": parse_error,
-                "parse_ok": parse_ok,
-                "behavior_label": None,
-                "actionability": None,
-                "latency_ms": dt_ms,
-            }
-            write_jsonl(cfg["output_path"], record)
-            completed.add(key)
+    total = len(pending) + skipped
+    print(f"[info] {len(pending)}/{total} pairs to run ({skipped} already done)")
+    async def run_session(writer: JsonlWriter) -> None:
+        # One HTTP/2 client for the whole run: streams multiplex over a single
+        # kept-alive TLS session instead of paying per-request handshakes.
+        http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=64, max_keepalive_connections=64, keepalive_expiry=30.0
+            ),
+        )
+        try:
+            client = AsyncGroq(api_key=api_key, http_client=http_client)
+            await run_all(client, cfg, pending, writer, cache=cache)
+        finally:
+            await http_client.aclose()
+
+    try:
+        if pending:
+            with JsonlWriter(cfg["output_path"]) as writer:
+                if cfg.get("executor", "asyncio") == "threads":
+                    run_all_threaded(Groq(api_key=api_key), cfg, pending, writer, cache=cache)
+                else:
+                    asyncio.run(run_session(writer))
+    finally:
+        if cache is not None:
+            print(f"[info] llm cache: {cache.hits} hits, {cache.misses} misses")
+            cache.close()
 
 
 if __name__ == "__main__":